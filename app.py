@@ -4,13 +4,26 @@ This script combines retrieval, SQL generation, and an optional Streamlit UI."""
 import os
 import sys
 import re
+import asyncio
+import time
+import queue
 import pickle
-from typing import Tuple, List, Dict
+import sqlite3
+import threading
+import functools
+import contextlib
+import importlib.util
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple, List, Dict, Callable, Optional, TYPE_CHECKING
 import numpy as np
-import faiss
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import sqlparse
 from sqlparse.exceptions import SQLParseError
-from sentence_transformers import SentenceTransformer
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -19,29 +32,91 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# faiss, torch, sentence_transformers, google.genai, numba and onnxruntime together take
+# seconds to import, and validate_sql or a quick script run needs none of them. So here
+# I only check if they are installed and import them where they are actually used.
+
+
+def _installed(module: str) -> bool:
+    try:
+        return importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        return False
+
 # ===== validate.py =====
 # A small helper section for SQL validation.
 #Prevents any destructive queries (like DROP, DELETE) from being executed accidentally.
-_FORBIDDEN = re.compile(
-    r'\b(DROP|DELETE|UPDATE|INSERT|ALTER|TRUNCATE|EXEC|MERGE)\b',
-    re.IGNORECASE
-)
-   
+# If google-re2 is installed I use it (DFA, no backtracking), otherwise the stdlib re.
+try:
+    import re2 as _re_engine
+except ImportError:
+    _re_engine = re
+
+_FORBIDDEN_WORDS = ('DROP', 'DELETE', 'UPDATE', 'INSERT', 'ALTER', 'TRUNCATE', 'EXEC', 'MERGE')
+_FORBIDDEN = _re_engine.compile(r'(?i)\b(' + '|'.join(_FORBIDDEN_WORDS) + r')\b')
+
+
+# With pyahocorasick installed, all eight keywords are found in one linear scan
+# of the query (Aho-Corasick automaton built once at import).
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+if AHOCORASICK_AVAILABLE:
+    _FORBIDDEN_AUTOMATON = ahocorasick.Automaton()
+    for _word in _FORBIDDEN_WORDS:
+        _FORBIDDEN_AUTOMATON.add_word(_word.lower(), _word.lower())
+    _FORBIDDEN_AUTOMATON.make_automaton()
+
+
+def _is_word_char(text: str, i: int) -> bool:
+    return 0 <= i < len(text) and (text[i].isalnum() or text[i] == '_')
+
+
+def _has_forbidden(query: str) -> bool:
+    """Cheap pre-screen first: plain substring checks on the uppercased query run in C
+    and almost every generated SELECT fails them all, so the word-boundary regex
+    only runs when one of the keywords actually shows up somewhere.
+    With the automaton the keyword scan is a single pass, and the word boundaries
+    (so updated_at is fine but UPDATE is not) are checked on the matches."""
+    if AHOCORASICK_AVAILABLE:
+        lower = query.lower()
+        for end, word in _FORBIDDEN_AUTOMATON.iter(lower):
+            if not _is_word_char(lower, end - len(word)) and not _is_word_char(lower, end + 1):
+                return True
+        return False
+    upper = query.upper()
+    if not any(word in upper for word in _FORBIDDEN_WORDS):
+        return False
+    return _FORBIDDEN.search(query) is not None
+
 
 # Checking if the SQL is safe and syntactically valid.
-# Returns (is_valid, message, formatted_sql)
+# Returns (is_valid, message, sql) where sql is only reformatted (reindent + upper-case
+# keywords) when pretty=True, i.e. when somebody is actually going to look at it.
+# It's a pure function, and the fallback path returns the same example SQL over and over,
+# so results are memoized.
 
-def validate_sql(query: str) -> Tuple[bool, str, str]:
-    if not query or not query.strip():
+@functools.lru_cache(maxsize=2048)
+def validate_sql(query: str, pretty: bool = False) -> Tuple[bool, str, str]:
+    if not query:
         return False, "Empty query", ""
-    if _FORBIDDEN.search(query):
+    if _has_forbidden(query):
         return False, "Forbidden or potentially destructive statement detected", ""
+    if not query.strip():
+        return False, "Empty query", ""
+    if not pretty:
+        return True, "OK", query
+    # No separate sqlparse.parse() pass anymore: it never comes back empty for a
+    # non-blank string, so it only cost a full pure-Python parse. format() parses
+    # the query once itself and still raises SQLParseError on garbage.
     try:
-        formatted = sqlparse.format(query, reindent=True, keyword_case='upper')
-        parsed = sqlparse.parse(formatted)
-        if not parsed:
-            return False, "Unable to parse SQL", formatted
-        return True, "OK", formatted
+        return True, "OK", sqlparse.format(query, reindent=True, keyword_case='upper')
     except SQLParseError as e:
         return False, f"SQL parse/format error: {e}", ""
 
@@ -49,135 +124,996 @@ def validate_sql(query: str) -> Tuple[bool, str, str]:
 # ===== generate.py =====
 # This section I created to handle communication with the Gemini API (if available ofc.)
  # and constructs the prompt for SQL generation accordingly.
-try:
-    from google import genai
-    from google.genai import types 
-    GENAI_AVAILABLE = True
-except ImportError:
-    GENAI_AVAILABLE = False
+GENAI_AVAILABLE = _installed("google.genai")
+
+_PROMPT_HEADER = (
+    "You are a SQL expert. Given these schemas and examples, generate a single SQL SELECT statement. "
+    "Output only the SQL query and nothing else.\n\n"
+)
+_CHARS_PER_TOKEN = 4  # rough estimate, only used when no tokenizer is given
+_WORD_CHAR = re.compile(r'\w')
+# Gemini sometimes wraps the answer in a markdown fence like ```sql ... ```
+# (the closing fence may be missing while the answer is still streaming in).
+# Compiled once, with re2 when it is installed, like _FORBIDDEN.
+_SQL_FENCE = _re_engine.compile(r'(?is)```(?:sql\b)?\s*(.*?)(?:```|$)')
+
+
+def _strip_fences(text: str) -> str:
+    """Returning the SQL inside the first markdown fence (or the text itself), stripped once."""
+    match = _SQL_FENCE.search(text)
+    return (match.group(1) if match else text).strip()
+
+
+# Near-duplicate chunks (same schema, question worded a bit differently) only make the
+# prompt longer, and Gemini's latency grows with prompt tokens. They are found with
+# MinHash over character 5-gram shingles: the share of equal signature slots estimates
+# the Jaccard similarity of the two shingle sets.
+_SHINGLE = 5
+_MINHASH_PERMS = 64
+_NEAR_DUPLICATE = 0.9
+_MERSENNE = (1 << 61) - 1
+_MINHASH_RNG = np.random.default_rng(0)
+_MINHASH_A = _MINHASH_RNG.integers(1, 1 << 32, _MINHASH_PERMS, dtype=np.uint64)
+_MINHASH_B = _MINHASH_RNG.integers(0, 1 << 32, _MINHASH_PERMS, dtype=np.uint64)
+
+
+def _minhash(text: str) -> np.ndarray:
+    text = " ".join(text.lower().split())
+    shingles = {text[i:i + _SHINGLE] for i in range(max(1, len(text) - _SHINGLE + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+    # (a*x + b) mod p for every permutation at once; x < 2^32 and a, b < 2^32 can't overflow uint64
+    return ((np.outer(hashes, _MINHASH_A) + _MINHASH_B) % _MERSENNE).min(axis=0)
+
+
+def _pack_contexts(contexts: List[Dict], token_counts: List[Optional[int]], max_tokens: int,
+                   count_tokens: Callable[[str], int]) -> List[Dict]:
+    """Picking retrieved contexts in rank order while they fit in max_tokens, skipping
+    near-duplicates of ones already picked. token_counts are the build-time counts
+    (Retriever.token_counts), count_tokens is only the fallback for chunks without one."""
+    packed, signatures = [], []
+    budget = max_tokens
+    for ctx, used in zip(contexts, token_counts):
+        text = ctx['chunk'].get('text', '')
+        if used is None:
+            used = count_tokens(text)
+        if used > budget:
+            continue
+        signature = _minhash(text)
+        if any(np.mean(signature == seen) >= _NEAR_DUPLICATE for seen in signatures):
+            continue
+        packed.append(ctx)
+        signatures.append(signature)
+        budget -= used
+    return packed
+
+
+# A streamed answer that sends nothing for this long is treated as stalled and asked again
+_GEMINI_TIMEOUT = 15.0
+_GEMINI_ATTEMPTS = 2
+
+
+@functools.lru_cache(maxsize=None)
+def _genai_client(api_key: str, timeout_ms: Optional[int] = None):
+    """One Gemini client per API key (and timeout) for the whole process.
+    Only the streamed answers use a timeout client: httpx applies it to every read, so it
+    catches a stalled stream, but it would also cut off a long non-streamed generate_content."""
+    from google import genai  # pylint: disable=import-outside-toplevel
+    from google.genai import types  # pylint: disable=import-outside-toplevel
+    if timeout_ms is None:
+        return genai.Client(api_key=api_key)
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=timeout_ms))
+
+
+@functools.lru_cache(maxsize=None)
+def _timeout_errors() -> tuple:
+    """What a timed out Gemini request raises. Only these are worth a second try,
+    a bad key or a rejected prompt fails the same way again."""
+    errors = [TimeoutError]
+    if _installed("httpx"):
+        import httpx  # pylint: disable=import-outside-toplevel
+        errors.append(httpx.TimeoutException)
+    return tuple(errors)
+
+
+@functools.lru_cache(maxsize=None)
+def _generation_config():
+    """The same temperature=0.2 config for every Gemini call, built once."""
+    from google.genai import types  # pylint: disable=import-outside-toplevel
+    return types.GenerateContentConfig(temperature=0.2)
+
 
 class SQLGenerator:
     """ This class handles SQL generation using Gemini + validation."""
 
-    def __init__(self, model_name: str = "gemini-2.5-flash"):
+    def __init__(self, model_name: str = "gemini-2.5-flash", tokenizer=None):
         self.api_key = os.getenv("GEMINI_API_KEY")
         if not self.api_key:
             raise RuntimeError("GEMINI_API_KEY not set in environment")
 
         if GENAI_AVAILABLE:
-            self.client = genai.Client(api_key=self.api_key)
+            self.client = _genai_client(self.api_key)
         self.model_name = model_name
+        # The prompt budget is counted in tokens of this (HF fast) tokenizer. It is not
+        # Gemini's tokenizer, but much closer than characters. Without one I estimate.
+        self.tokenizer = tokenizer
+
+    def _count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return -(-len(text) // _CHARS_PER_TOKEN)
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _truncate(self, text: str, max_tokens: int) -> Tuple[str, int]:
+        """Cutting text to at most max_tokens, on a token boundary and never in the middle
+        of an identifier (word pieces can split one). Returns (text, token_count)."""
+        if self.tokenizer is None:
+            cut = max_tokens * _CHARS_PER_TOKEN
+            offsets = None
+        else:
+            offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+            if len(offsets) <= max_tokens:
+                return text, len(offsets)
+            cut = offsets[max_tokens - 1][1] if max_tokens > 0 else 0
+        if cut >= len(text):
+            return text, self._count_tokens(text) if offsets is None else len(offsets)
+        while cut > 0 and _WORD_CHAR.match(text[cut - 1]) and _WORD_CHAR.match(text[cut]):
+            cut -= 1
+        take = text[:cut]
+        if offsets is None:
+            return take, self._count_tokens(take)
+        return take, sum(1 for _, end in offsets if end <= cut)
 
-    def _build_prompt(self, user_question: str, contexts: List[Dict], max_context_chars: int = 3000) -> str:
+    def _build_prompt(self, user_question: str, contexts: List[Dict], max_context_tokens: int = 750,
+                      token_counts: Optional[List[Optional[int]]] = None) -> str:
         """
         Builds the input prompt for Gemini.
         Includes the most relevant schemas and examples from the retriever.
+        The budget covers both the schema text and the example SQL, so adding more
+        contexts can't push the prompt past max_context_tokens. With the precomputed
+        token_counts of the chunks' texts (Retriever.token_counts), only the one chunk
+        that overflows the budget gets tokenized here.
         """
-        lines = [
-            "You are a SQL expert. Given these schemas and examples, generate a single SQL SELECT statement. Output only the SQL query and nothing else.\n"
-        ]
-        used = 0
-        for ctx in contexts:
-            text = ctx.get("text", "")
-            example = ctx.get("answer", "")
-            if used >= max_context_chars:
+        pieces = []
+        budget = max_context_tokens
+        token_counts = token_counts or [None] * len(contexts)
+        for ctx, used in zip(contexts, token_counts):
+            if budget <= 0:
                 break
-            remaining = max_context_chars - used
-            text_trunc = text[:remaining]
-            used += len(text_trunc)
-            lines.extend([
-                f"Schema: {text_trunc}",
-                f"Example: {example}",
-                ""
-            ])
-        lines.append(f"User question: {user_question}")
-        lines.append("SQL:")
-        return "\n".join(lines)
-
-    def generate_query(self, user_question: str, contexts: List[Dict]) -> Dict:
+            take = ctx.get("text", "")
+            if used is None or used > budget:
+                take, used = self._truncate(take, budget)
+            example = ctx.get("answer", "")
+            pieces.append(f"Schema: {take}\nExample: {example}\n\n")
+            budget -= used + self._count_tokens(example)
+        return f"{_PROMPT_HEADER}{''.join(pieces)}User question: {user_question}\nSQL:"
+
+    def generate_query(self, user_question: str, contexts: List[Dict],
+                       on_partial: Optional[Callable[[str], None]] = None, pretty: bool = False,
+                       token_counts: Optional[List[Optional[int]]] = None) -> Dict:
         """
         Generate SQL from the retrieved context using Gemini as I mentioned earlier this section.
         In the case of failed API it falls back to example answers.
+        With on_partial the answer is streamed and the callback gets the text so far after
+        every chunk, so the UI can show the SQL while it is still being written.
+        pretty=True formats the valid SQL for display.
         """
-        prompt = self._build_prompt(user_question, contexts)
+        prompt = self._build_prompt(user_question, contexts, token_counts=token_counts)
 
         sql_text = ""
         try:
             if GENAI_AVAILABLE:
-                response = self.client.models.generate_content(
+                config = _generation_config()
+                if on_partial is None:
+                    response = self.client.models.generate_content(
+                        model=self.model_name,
+                        contents=prompt,
+                        config=config
+                    )
+                    sql_text = response.text
+                else:
+                    for chunk in self.client.models.generate_content_stream(
+                        model=self.model_name,
+                        contents=prompt,
+                        config=config
+                    ):
+                        sql_text += chunk.text or ""
+                        on_partial(_strip_fences(sql_text))
+                # Since Gemini sometimes wraps code in markdown, I clean that up here.
+                sql_text = _strip_fences(sql_text)
+            else:
+                 # Fallback: return example SQL if Gemini is not available
+                sql_text = contexts[0].get("answer", "") if contexts else ""
+        except Exception:
+            return self._fallback(contexts)
+        return self._validated(sql_text, pretty)
+
+    async def agenerate_query(self, user_question: str, contexts: List[Dict], pretty: bool = False,
+                              token_counts: Optional[List[Optional[int]]] = None) -> Dict:
+        """
+        Async twin of generate_query (without streaming) on the client's aio API,
+        so many questions can wait on Gemini at the same time.
+        """
+        prompt = self._build_prompt(user_question, contexts, token_counts=token_counts)
+        try:
+            if GENAI_AVAILABLE:
+                response = await self.client.aio.models.generate_content(
                     model=self.model_name,
                     contents=prompt,
-                    config=types.GenerateContentConfig(temperature=0.2)
+                    config=_generation_config()
                 )
-                sql_text = response.text.strip()
-                # Since Gemini sometimes wraps code in markdown, I clean that up here.
-                if "```sql" in sql_text.lower():
-                    sql_text = sql_text.split("```sql")[1].split("```")[0].strip()
-                elif "```" in sql_text:
-                    sql_text = sql_text.split("```")[1].split("```")[0].strip()
+                sql_text = _strip_fences(response.text)
             else:
-                 # Fallback: return example SQL if Gemini is not available
                 sql_text = contexts[0].get("answer", "") if contexts else ""
         except Exception:
-            sql_text = contexts[0].get("answer", "") if contexts else ""
-            return {
-                "sql": sql_text,
-                "valid": False,
-                "validation_message": "Gemini error. Fallback used."
-            }
-
-        is_valid, message, formatted = validate_sql(sql_text)
+            return self._fallback(contexts)
+        return self._validated(sql_text, pretty)
+
+    @staticmethod
+    def _fallback(contexts: List[Dict]) -> Dict:
+        return {
+            "sql": contexts[0].get("answer", "") if contexts else "",
+            "valid": False,
+            "validation_message": "Gemini error. Fallback used."
+        }
+
+    @staticmethod
+    def _validated(sql_text: str, pretty: bool) -> Dict:
+        is_valid, message, formatted = validate_sql(sql_text, pretty)
         return {
             "sql": formatted if is_valid else sql_text,
             "valid": is_valid,
             "validation_message": message,
         }
 
-def ask_gemini(prompt: str) -> str:
+# Answers of earlier prompts, so asking the exact same prompt twice skips the RPC.
+# Only successful answers go in. (An OrderedDict LRU and not lru_cache, because
+# streamed answers have to be stored once the stream is complete.)
+_ANSWER_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_ANSWER_CACHE_SIZE = 256
+_ANSWER_LOCK = threading.Lock()
+
+
+def _cached_answer(prompt: str) -> Optional[str]:
+    with _ANSWER_LOCK:
+        answer = _ANSWER_CACHE.get(prompt)
+        if answer is not None:
+            _ANSWER_CACHE.move_to_end(prompt)
+        return answer
+
+
+def _remember_answer(prompt: str, answer: str) -> None:
+    with _ANSWER_LOCK:
+        _ANSWER_CACHE[prompt] = answer
+        if len(_ANSWER_CACHE) > _ANSWER_CACHE_SIZE:
+            _ANSWER_CACHE.popitem(last=False)
+
+
+def _gemini_text(prompt: str, on_partial: Optional[Callable[[str], None]] = None) -> str:
+    """Streaming the answer, on_partial gets the text so far after every chunk, so the
+    first words are on screen long before the whole answer is generated.
+    A stalled stream times out and is started again, on_partial then gets "" and the
+    text starts over. It raises on failure, the caller turns that into a message."""
+    client = _genai_client(os.getenv("GEMINI_API_KEY"), int(_GEMINI_TIMEOUT * 1000))
+    for attempt in range(_GEMINI_ATTEMPTS):
+        if attempt and on_partial is not None:
+            on_partial("")
+        text = ""
+        try:
+            for chunk in client.models.generate_content_stream(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config=_generation_config()
+            ):
+                text += chunk.text or ""
+                if on_partial is not None:
+                    on_partial(text)
+            return text
+        except _timeout_errors():
+            if attempt == _GEMINI_ATTEMPTS - 1:
+                raise
+    return ""
+
+
+def ask_gemini(prompt: str, on_partial: Optional[Callable[[str], None]] = None) -> str:
     """
     A simpler helper for getting Gemini responses in natural language (not just SQL).
     Used mostly in the chat or Streamlit interface.
     """
     if not GENAI_AVAILABLE:
         return "[Gemini not available]"
-    try:
-        client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(temperature=0.2)
-        )
-        return response.text
-    except Exception as e:
-        return f"[Error communicating with Gemini API: {e}]"
+    answer = _cached_answer(prompt)
+    if answer is None:
+        try:
+            answer = _gemini_text(prompt, on_partial)
+        except Exception as e:
+            return f"[Error communicating with Gemini API: {e}]"
+        _remember_answer(prompt, answer)
+    elif on_partial is not None:
+        on_partial(answer)
+    return answer
+
+
+async def aask_gemini(prompt: str) -> str:
+    """Async version of ask_gemini on the client's aio API (shares its cache).
+    A call that takes longer than the timeout is cancelled and tried once more."""
+    if not GENAI_AVAILABLE:
+        return "[Gemini not available]"
+    answer = _cached_answer(prompt)
+    if answer is not None:
+        return answer
+    client = _genai_client(os.getenv("GEMINI_API_KEY"))
+    for attempt in range(_GEMINI_ATTEMPTS):
+        try:
+            response = await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model="gemini-2.5-flash",
+                    contents=prompt,
+                    config=_generation_config()
+                ),
+                timeout=_GEMINI_TIMEOUT,
+            )
+            _remember_answer(prompt, response.text)
+            return response.text
+        except asyncio.TimeoutError:
+            if attempt == _GEMINI_ATTEMPTS - 1:
+                return f"[Error communicating with Gemini API: no response after {_GEMINI_TIMEOUT:.0f}s]"
+        except Exception as e:
+            return f"[Error communicating with Gemini API: {e}]"
+    return ""
+
+
+async def batch_ask_gemini(prompts: List[str], concurrency: int = 20) -> List[str]:
+    """Sending many prompts concurrently, at most `concurrency` in flight so we stay
+    under the per-minute quota. Answers come back in the order of the prompts."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(prompt: str) -> str:
+        async with semaphore:
+            return await aask_gemini(prompt)
+
+    return await asyncio.gather(*(one(p) for p in prompts))
 
 
 # ===== retrieve.py =====
 # The retriever part where the chatbot finds the most relevant schema chunks based on user question.
+TORCH_AVAILABLE = _installed("torch")
+NUMBA_AVAILABLE = _installed("numba")
+
+
+@functools.lru_cache(maxsize=None)
+def _top3_kernel():
+    """Importing numba and jitting _top3 on first use (cache=True keeps the compiled
+    version on disk, so later runs only pay the import). Returns None when numba is
+    installed but can't be imported (e.g. "Numba needs NumPy x.y or less"), the
+    search then just uses argpartition."""
+    try:
+        import numba  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+
+    @numba.njit(cache=True)
+    def _top3(scores):
+        """Single pass top-3 per row for the default k=3, no length-N temporaries
+        like argpartition needs. Returns (distances, indices) shaped (n_rows, 3)."""
+        n_rows = scores.shape[0]
+        distances = np.empty((n_rows, 3), dtype=np.float32)
+        indices = np.empty((n_rows, 3), dtype=np.int64)
+        for r in range(n_rows):
+            a = b = c = -1e30
+            ia = ib = ic = -1
+            for i in range(scores.shape[1]):
+                s = scores[r, i]
+                if s > a:
+                    c, ic = b, ib
+                    b, ib = a, ia
+                    a, ia = s, i
+                elif s > b:
+                    c, ic = b, ib
+                    b, ib = s, i
+                elif s > c:
+                    c, ic = s, i
+            distances[r, 0], distances[r, 1], distances[r, 2] = a, b, c
+            indices[r, 0], indices[r, 1], indices[r, 2] = ia, ib, ic
+        return distances, indices
+
+    return _top3
+
+
+ONNX_AVAILABLE = _installed("onnxruntime") and _installed("transformers")
+
+
+class OnnxEncoder:
+    """Stand-in for SentenceTransformer running the int8 model from export_onnx.py on
+    ONNX Runtime (AVX-512 VNNI int8 dot products instead of FP32 PyTorch).
+    Same pipeline as the original: tokenize, transformer, mean pooling, optional L2 norm."""
+
+    def __init__(self, path: str, max_seq_length: int = 384):
+        if not ONNX_AVAILABLE:
+            raise RuntimeError("onnxruntime and transformers are needed for the ONNX encoder")
+        import onnxruntime as ort  # pylint: disable=import-outside-toplevel
+        from transformers import AutoConfig, AutoTokenizer  # pylint: disable=import-outside-toplevel
+        self.session = ort.InferenceSession(
+            os.path.join(path, 'model_quantized.onnx'), providers=['CPUExecutionProvider']
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.max_seq_length = max_seq_length
+        self._dim = AutoConfig.from_pretrained(path).hidden_size
+
+    def eval(self):
+        return self
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, sentences: List[str], batch_size: int = 32, normalize_embeddings: bool = False,
+               **_kwargs) -> np.ndarray:
+        out = np.empty((len(sentences), self._dim), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch = self.tokenizer(
+                sentences[start:start + batch_size], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors='np'
+            )
+            feeds = {name: batch[name].astype(np.int64) for name in self._input_names}
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = batch['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            out[start:start + len(pooled)] = pooled
+        return out
+
+
+# One SentenceTransformer per model name for the whole process, so the CLI path and
+# any other caller share the ~1 GB model instead of loading it again.
+_MODEL_SINGLETON: Dict[str, "SentenceTransformer"] = {}
+_MODEL_LOCK = threading.Lock()
+
+
+def _load_model(model_name: str, onnx_path: Optional[str] = None):
+    key = onnx_path or model_name
+    with _MODEL_LOCK:
+        model = _MODEL_SINGLETON.get(key)
+        if model is None:
+            if onnx_path:
+                model = OnnxEncoder(onnx_path)
+            else:
+                from sentence_transformers import SentenceTransformer  # pylint: disable=import-outside-toplevel
+                model = SentenceTransformer(model_name)
+            model.eval()
+            _MODEL_SINGLETON[key] = model
+        return model
+
+
+def _cpu_cores() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=None)
+def _split_torch_threads(workers: int, reserved: int = 0) -> None:
+    """Giving every encode worker its own share of the cores: N forwards with
+    cores/N intra-op threads each instead of N forwards all fighting over every core.
+    `reserved` cores are left for FAISS's OpenMP threads.
+    torch.set_num_threads is process-wide, so this runs once per setting."""
+    import torch  # pylint: disable=import-outside-toplevel
+    torch.set_num_threads(max(1, (_cpu_cores() - reserved) // workers))
+
+
+def _tune_faiss_threads(index) -> int:
+    """FAISS searches with OpenMP on every core by default, right next to torch doing the
+    same, and the two oversubscribe the CPU. A flat scan over our small batches gains
+    less from the threads than it pays to dispatch them, so it runs on one; the other
+    indexes get half the cores. Returns the thread count."""
+    import faiss  # pylint: disable=import-outside-toplevel
+    threads = 1 if isinstance(index, faiss.IndexFlat) else max(1, _cpu_cores() // 2)
+    faiss.omp_set_num_threads(threads)
+    return threads
+
+
+def _inference_mode():
+    """torch.inference_mode() skips the autograd bookkeeping, which we never need here."""
+    if not TORCH_AVAILABLE:
+        return contextlib.nullcontext()
+    import torch  # pylint: disable=import-outside-toplevel
+    return torch.inference_mode()
+
+
+class CacheStore:
+    """On-disk query cache so cache hits survive restarts (Streamlit reloads a lot).
+    Rows (query, emb_offset, indices, scores, ts) live in SQLite and the embeddings
+    themselves in a float32 np.memmap sidecar file, so lookups don't allocate.
+    The stored chunk indices only mean something for the corpus, index and encoder they
+    came from, so the cache remembers a fingerprint of those and starts empty when it changes."""
+
+    GROW_ROWS = 4096
+    TTL_SECONDS = 7 * 24 * 3600
+
+    def __init__(self, path: str, dim: int, ttl: float = TTL_SECONDS, fingerprint: str = ""):
+        self.dim = dim
+        self._emb_path = path + '.f32'
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path + '.sqlite', check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "query TEXT PRIMARY KEY, emb_offset INT, indices BLOB, scores BLOB, ts REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS queries_offset ON queries(emb_offset)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        self._check_fingerprint(f"{fingerprint}|dim={dim}")
+        self._sweep(ttl)
+        # Several processes can share the same cache files (Streamlit workers, --cli), so
+        # row offsets are never tracked in memory: put() allocates them inside a SQLite
+        # write transaction and _n (rows worth scanning) is re-read from the database.
+        self._n = self._used_rows()
+        self._grow(max(self._n, 1))
+
+    def _used_rows(self) -> int:
+        return self._db.execute("SELECT COALESCE(MAX(emb_offset) + 1, 0) FROM queries").fetchone()[0]
+
+    def _free_offset(self) -> int:
+        """Lowest offset no entry uses (offsets freed by the TTL sweep get reused, so the
+        sidecar file does not grow forever). Must run inside the write transaction."""
+        return self._db.execute(
+            "SELECT CASE WHEN NOT EXISTS (SELECT 1 FROM queries WHERE emb_offset = 0) THEN 0 "
+            "ELSE (SELECT MIN(q.emb_offset) + 1 FROM queries q WHERE NOT EXISTS "
+            "(SELECT 1 FROM queries r WHERE r.emb_offset = q.emb_offset + 1)) END"
+        ).fetchone()[0]
+
+    def _ensure_rows(self, rows: int) -> None:
+        """Remapping when another process (or put) has grown the file past our mapping."""
+        if rows > len(self._mat):
+            self._grow(rows)
+
+    def _grow(self, rows: int) -> None:
+        """(Re)mapping the embedding file with room for at least `rows` rows, in GROW_ROWS steps."""
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._emb_path) if os.path.exists(self._emb_path) else 0
+        capacity = max(size // row_bytes, -(-rows // self.GROW_ROWS) * self.GROW_ROWS)
+        if size < capacity * row_bytes:
+            with open(self._emb_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self._mat = np.memmap(self._emb_path, dtype='float32', mode='r+', shape=(capacity, self.dim))
+
+    def _check_fingerprint(self, fingerprint: str) -> None:
+        """Emptying the cache when it was filled for another corpus/index/encoder (or by a
+        version that didn't record one), otherwise it would hand out indices of the old build."""
+        with self._db:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+            if row is not None and row[0] == fingerprint:
+                return
+            self._db.execute("DELETE FROM queries")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            if os.path.exists(self._emb_path) and os.path.getsize(self._emb_path):
+                # Zeroed rather than truncated, another process may still have it mapped
+                mat = np.memmap(self._emb_path, dtype='float32', mode='r+')
+                mat[:] = 0.0
+                mat.flush()
+
+    def _sweep(self, ttl: float) -> None:
+        """Dropping entries older than the TTL and zeroing their embedding rows."""
+        cutoff = time.time() - ttl
+        with self._db:
+            stale = [r[0] for r in self._db.execute("SELECT emb_offset FROM queries WHERE ts < ?", (cutoff,))]
+            self._db.execute("DELETE FROM queries WHERE ts < ?", (cutoff,))
+        if stale and os.path.exists(self._emb_path):
+            mat = np.memmap(self._emb_path, dtype='float32', mode='r+').reshape(-1, self.dim)
+            mat[[o for o in stale if o < len(mat)]] = 0.0
+            mat.flush()
+
+    @staticmethod
+    def _decode(indices: bytes, scores: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        return (np.frombuffer(scores, dtype='float32').reshape(1, -1),
+                np.frombuffer(indices, dtype='int64').reshape(1, -1))
+
+    def lookup(self, query: str):
+        """Exact match on the query string. Returns (offset, distances, indices) or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT emb_offset, indices, scores FROM queries WHERE query = ?", (query,)
+            ).fetchone()
+        if row is None:
+            return None
+        return (row[0], *self._decode(row[1], row[2]))
+
+    def nearest(self, emb: np.ndarray, threshold: float):
+        """Closest cached query by cosine. For a few thousand rows a plain
+        matmul is cheaper than keeping a FAISS index around."""
+        with self._lock:
+            self._n = self._used_rows()
+            if not self._n:
+                return None
+            self._ensure_rows(self._n)
+            sims = self._mat[:self._n] @ emb[0]
+            best = int(np.argmax(sims))
+            if sims[best] < threshold:
+                return None
+            row = self._db.execute(
+                "SELECT indices, scores FROM queries WHERE emb_offset = ?", (best,)
+            ).fetchone()
+        if row is None:
+            return None
+        return (best, *self._decode(row[0], row[1]))
+
+    def embedding(self, offset: int) -> np.ndarray:
+        with self._lock:
+            self._ensure_rows(offset + 1)
+            return self._mat[offset:offset + 1]
+
+    def put(self, query: str, emb: np.ndarray, distances: np.ndarray, indices: np.ndarray) -> None:
+        with self._lock, self._db:
+            # BEGIN IMMEDIATE takes the database write lock right away, so no other
+            # process can pick the same offset until this entry is committed
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute("SELECT emb_offset FROM queries WHERE query = ?", (query,)).fetchone()
+            offset = row[0] if row is not None else self._free_offset()
+            self._ensure_rows(offset + 1)
+            # The mapping is shared, so other processes see the row without a flush
+            self._mat[offset] = emb[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?)",
+                (query, offset, indices.astype('int64').tobytes(),
+                 distances.astype('float32').tobytes(), time.time())
+            )
+            self._n = max(self._n, offset + 1)
+
+    def update(self, offset: int, distances: np.ndarray, indices: np.ndarray) -> None:
+        """Replacing the stored result of an entry (used when the same question comes with a bigger k)."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE queries SET indices = ?, scores = ? WHERE emb_offset = ?",
+                (indices.astype('int64').tobytes(), distances.astype('float32').tobytes(), offset)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class _MicroBatcher:
+    """Collecting requests from concurrent callers into small batches: a worker thread
+    takes up to `max_batch` items that arrive within `window` seconds and hands them to
+    `batch_fn` as one list (one encoder forward / one matmul instead of many tiny ones).
+    With workers > 1 several batches run at once, so batch_fn has to be thread-safe."""
+
+    def __init__(self, batch_fn, window: float = 0.01, max_batch: int = 16, workers: int = 1):
+        self._batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item) -> Future:
+        if self._closed:
+            raise RuntimeError("the batcher is closed")
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        """Stopping the workers. Requests already queued are still answered, the None
+        markers sit behind them in the queue (one per worker)."""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                results = self._batch_fn([item for item, _ in batch])
+            except Exception as e:  # pylint: disable=broad-except
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+# Retrievers already built in this process, keyed by their files (and the files' mtimes,
+# so rebuilding the embeddings gives a fresh one) plus the constructor options.
+_RETRIEVERS: Dict[tuple, "Retriever"] = {}
+_RETRIEVERS_LOCK = threading.Lock()
+
+
+def _mtime(path: Optional[str]) -> Optional[float]:
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
 
 class Retriever:
     """This class is for fetching top-k schema chunks and then generates SQL."""
 
-    def __init__(self, index_path='embeddings.faiss', chunks_path='chunks.pkl', model_name='all-mpnet-base-v2'):
-     # Checking if embeddings and chunks exist
-        if not os.path.exists(index_path):
-            raise FileNotFoundError(f"FAISS index not found: {index_path}")
-        if not os.path.exists(chunks_path):
-            raise FileNotFoundError(f"Chunks file not found: {chunks_path}")
-        
+    @classmethod
+    def get_or_create(cls, index_path='embeddings.faiss', chunks_path='chunks.arrow',
+                      registry: Optional[Dict[tuple, "Retriever"]] = None, **kwargs) -> "Retriever":
+        """Returning the shared Retriever for these files instead of loading the index,
+        chunks and model again. Takes the same arguments as the constructor, `registry`
+        replaces the module-level _RETRIEVERS (Streamlit passes one that survives reruns)."""
+        if registry is None:
+            registry = _RETRIEVERS
+        paths = (index_path, chunks_path, kwargs.get('corpus_path', 'embeddings.npy'))
+        key = (
+            tuple(os.path.abspath(p) if p else None for p in paths),
+            tuple(_mtime(p) for p in paths),
+            tuple(sorted(kwargs.items())),
+        )
+        with _RETRIEVERS_LOCK:
+            retriever = registry.get(key)
+            if retriever is None:
+                # Only the newest build of the same files is worth keeping around, and the
+                # old one has to be closed or its batcher threads keep it (and the model) alive
+                for old_key in [k for k in registry if k[0] == key[0] and k[2] == key[2]]:
+                    registry.pop(old_key).close()
+                retriever = cls(index_path, chunks_path, **kwargs)
+                registry[key] = retriever
+            return retriever
+
+    def __init__(self, index_path='embeddings.faiss', chunks_path='chunks.arrow', model_name='all-mpnet-base-v2',
+                 corpus_path='embeddings.npy', rerank_path='embeddings.f16.npy', rerank_depth: int = 50,
+                 cache_path='query_cache', cache_threshold: float = 0.95, cache_size: int = 4096,
+                 use_gpu: bool = True, batch_window: float = 0.01, max_batch: int = 16,
+                 index_factory=None, ann_min_chunks: int = 10_000, onnx_path: Optional[str] = None,
+                 encode_workers: int = 1):
+        # If the raw normalized matrix is there I search it with a NumPy matmul,
+        # FAISS is only the fallback for older builds that don't have embeddings.npy.
+        # To search a compressed index instead: index_path='embeddings.pq.faiss' (or the 8-bit
+        # 'embeddings.sq8.faiss'), corpus_path=None
+        self.index = None
+        self.corpus = None
+        self.rerank_vectors = None
+        self.rerank_depth = rerank_depth
+        # No exists() checks up front: opening a file is the check, and a missing
+        # index/chunks file raises from here (the UI catches it, see load_retriever)
+        if corpus_path:
+            with contextlib.suppress(FileNotFoundError):
+                self.corpus = np.load(corpus_path, mmap_mode='r')
+
         # Now its time to Load FAISS index and the chunks from disk
-        self.index = faiss.read_index(index_path)
-        with open(chunks_path, 'rb') as f:
-            self.chunks = pickle.load(f)
-        
+        if self.corpus is None:
+            import faiss  # pylint: disable=import-outside-toplevel
+            # Memory-mapped and read-only: the vectors stay in the OS page cache, so
+            # reopening (or a second Streamlit worker) doesn't read/copy the whole file again
+            self.index = faiss.read_index(index_path, faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP)
+            # PQ scores are approximate, so the top candidates get re-scored exactly
+            # from a float16 copy of the vectors (memory-mapped, only a few rows are touched)
+            if rerank_path and not isinstance(self.index, faiss.IndexFlat):
+                with contextlib.suppress(FileNotFoundError):
+                    self.rerank_vectors = np.load(rerank_path, mmap_mode='r')
+        self._load_chunks(chunks_path)
+        # The file the searched vectors come from. Kept here because the ANN switch below
+        # drops self.corpus, and the query cache fingerprint has to follow this file
+        self._vectors_path = corpus_path if self.corpus is not None else index_path
+
+        # Optional sub-linear search, e.g. index_factory="HNSW32" (or "IVF256,PQ32" for less
+        # memory). Small corpora stay on the exact flat search, it is fast enough there.
+        self._ann_factory = None
+        if index_factory and self.num_chunks >= ann_min_chunks:
+            self._use_ann_index(index_path, index_factory, self._vectors_path)
+            self._ann_factory = index_factory
+
+        # With a CUDA GPU the flat search moves there (PQ indexes stay on the CPU).
+        # Careful: single queries on the GPU can be slower than on the CPU, so on the
+        # GPU the batching window below is stretched to 20 ms. use_gpu=False turns it off.
+        self.gpu_index = None
+        if use_gpu and TORCH_AVAILABLE and self._has_gpu():
+            import faiss  # pylint: disable=import-outside-toplevel
+            import faiss.contrib.torch_utils  # pylint: disable=import-outside-toplevel,unused-import
+            self._gpu_res = faiss.StandardGpuResources()
+            if self.corpus is not None:
+                self.gpu_index = faiss.GpuIndexFlatIP(self._gpu_res, self.corpus.shape[1])
+                self.gpu_index.add(np.ascontiguousarray(self.corpus))
+            elif isinstance(self.index, faiss.IndexFlat):
+                self.gpu_index = faiss.index_cpu_to_gpu(self._gpu_res, 0, self.index)
+            if self.gpu_index is not None:
+                batch_window = max(batch_window, 0.02)
+
         # Loading now the same SentenceTransformer model I used for embeddings
-        self.model = SentenceTransformer(model_name)
-        self.generator = SQLGenerator()
+        # (or its int8 ONNX export, onnx_path='onnx_encoder_int8', see export_onnx.py)
+        self.model = _load_model(model_name, onnx_path)
+        # all-mpnet-base-v2 ends with a Normalize module, so its output is unit-norm
+        # already and asking encode() to normalize again is a wasted pass
+        self._needs_norm = not self._ends_with_normalize(self.model)
+        self.generator = SQLGenerator(tokenizer=self.model.tokenizer)
+
+        # Query cache: exact repeats skip the encoder (LRU), and paraphrases whose
+        # embedding is close enough (cosine >= cache_threshold) reuse the old search result.
+        # The search results are persisted in cache_path (pass None to keep nothing on disk).
+        self.cache_threshold = cache_threshold
+        self.cache_size = cache_size
+        self._exact_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._exact_lock = threading.Lock()
+        # Cache keys are the stripped query, and lowercased too when the model's tokenizer
+        # lowercases anyway (all-mpnet-base-v2 does): same embedding, more hits
+        self._lowercase_keys = bool(getattr(self.model.tokenizer, 'do_lower_case', False))
+        self.cache = None
+        if cache_path:
+            self.cache = CacheStore(
+                cache_path, self.model.get_sentence_embedding_dimension(),
+                fingerprint=self._cache_fingerprint(model_name, onnx_path),
+            )
+
+        # Every lookup goes through the micro-batcher, so queries arriving at the same
+        # time (several Streamlit sessions) share one encoder forward and one search.
+        # For a busy multi-client server, encode_workers > 1 runs that many batches in
+        # parallel on the CPU (the torch forward releases the GIL), each with its share
+        # of the cores. The GPU keeps one worker, it is already busy with one batch.
+        if self.gpu_index is not None:
+            encode_workers = 1
+        faiss_threads = 0
+        if self.index is not None and self.gpu_index is None:
+            faiss_threads = _tune_faiss_threads(self.index)
+        if (encode_workers > 1 or faiss_threads > 1) and TORCH_AVAILABLE and not onnx_path:
+            _split_torch_threads(encode_workers, faiss_threads if faiss_threads > 1 else 0)
+        self._batcher = _MicroBatcher(
+            self._resolve, window=batch_window, max_batch=max_batch, workers=encode_workers
+        )
+
+    def close(self) -> None:
+        """Stopping the batcher threads and closing the query cache. Searches that are
+        already queued still finish, new ones raise RuntimeError."""
+        self._batcher.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def _cache_fingerprint(self, model_name: str, onnx_path: Optional[str]) -> str:
+        """What the cached search results depend on: the vectors file that is searched (path,
+        size, mtime), how it is searched (matmul or which FAISS index) and the query encoder."""
+        source = self._vectors_path
+        info = os.stat(source)
+        search = type(self.index).__name__ if self.index is not None else 'matmul'
+        if self._ann_factory:
+            search += f"({self._ann_factory})"
+        return (f"{os.path.abspath(source)}|{info.st_size}|{info.st_mtime_ns}|{search}"
+                f"|{os.path.abspath(onnx_path) if onnx_path else model_name}")
+
+    @staticmethod
+    def _ends_with_normalize(model) -> bool:
+        """Checking the last module of a SentenceTransformer pipeline. The ONNX encoder
+        isn't indexable and has no such module, it normalizes through normalize_embeddings."""
+        try:
+            last = model[-1]
+        except (TypeError, IndexError, KeyError):
+            return False
+        return type(last).__name__ == 'Normalize'
 
-    def get_response(self, query: str, k: int = 3):
+    @staticmethod
+    def _has_gpu() -> bool:
+        """Asking torch first (sentence_transformers loads it anyway), so CPU-only
+        machines searching embeddings.npy never have to import faiss at all."""
+        import torch  # pylint: disable=import-outside-toplevel
+        if not torch.cuda.is_available():
+            return False
+        import faiss  # pylint: disable=import-outside-toplevel
+        return hasattr(faiss, 'StandardGpuResources') and faiss.get_num_gpus() > 0
+
+    def _use_ann_index(self, index_path: str, index_factory: str, source_path: str) -> None:
+        """Switching to an ANN index built once from the flat vectors and saved next to
+        index_path (embeddings.hnsw32.faiss etc.), so later starts just open it.
+        A saved index older than the vectors it came from (source_path), or with a different
+        number of vectors than there are chunks, is from an earlier build and gets rebuilt."""
+        import faiss  # pylint: disable=import-outside-toplevel
+        slug = re.sub(r'\W+', '_', index_factory).strip('_').lower()
+        ann_path = f"{os.path.splitext(index_path)[0]}.{slug}.faiss"
+        index = None
+        ann_mtime = _mtime(ann_path)
+        if ann_mtime is not None and ann_mtime >= (_mtime(source_path) or 0.0):
+            index = faiss.read_index(ann_path, faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP)
+            if index.ntotal != self.num_chunks:
+                index = None
+        if index is None:
+            if self.corpus is not None:
+                vectors = np.ascontiguousarray(self.corpus)
+            else:
+                vectors = self.index.reconstruct_n(0, self.index.ntotal)
+            index = faiss.index_factory(vectors.shape[1], index_factory, faiss.METRIC_INNER_PRODUCT)
+            if not index.is_trained:
+                index.train(vectors)  # pylint: disable=E1120
+            index.add(vectors)  # pylint: disable=E1120
+            # Written next to it and renamed over, a running process may still have the old file mapped
+            faiss.write_index(index, ann_path + '.tmp')
+            os.replace(ann_path + '.tmp', ann_path)
+
+        # Query-time knobs; each one only applies to its own index type
+        params = faiss.ParameterSpace()
+        for name, value in (('efSearch', 64), ('nprobe', 8)):
+            try:
+                params.set_index_parameter(index, name, value)
+            except RuntimeError:
+                pass
+
+        # The full-precision vectors (if any) are still good for re-scoring the ANN candidates
+        if self.rerank_vectors is None and self.corpus is not None:
+            self.rerank_vectors = self.corpus
+        self.index = index
+        self.corpus = None
+
+    @staticmethod
+    def _read_chunks_table(chunks_path: str) -> pa.Table:
+        if chunks_path.endswith('.arrow'):
+            return pa.ipc.open_file(pa.memory_map(chunks_path)).read_all()
+        if chunks_path.endswith('.parquet'):
+            return pq.ParquetFile(pa.memory_map(chunks_path)).read()
+        with open(chunks_path, 'rb') as f:
+            chunks = pickle.load(f)
+        return pa.table({
+            'text': [c['text'] for c in chunks],
+            'answer': [c['answer'] for c in chunks],
+        })
+
+    def _load_chunks(self, chunks_path: str) -> None:
+        """Chunks are kept column-wise: text and answer strings sit in contiguous Arrow
+        buffers instead of one Python dict per row. chunks.arrow is memory-mapped and used
+        in place; the Parquet and pickle files of older builds are converted on load."""
+        # Builds from before the Arrow store only have chunks.parquet, or even older the pickle
+        stem, ext = os.path.splitext(chunks_path)
+        candidates = [chunks_path]
+        if ext in ('.arrow', '.parquet'):
+            candidates += [stem + e for e in ('.parquet', '.pkl') if e != ext]
+        for path in candidates:
+            try:
+                table = self._read_chunks_table(path)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            raise FileNotFoundError(f"Chunks file not found: {', '.join(candidates)}")
+        self.chunks_text = table.column('text')
+        self.chunks_answer = table.column('answer')
+        # Token counts of 'text', computed once at build time for the prompt budget
+        self.chunks_tokens = table.column('token_count') if 'token_count' in table.column_names else None
+        self.num_chunks = table.num_rows
+
+    def _chunks(self, indices: List[int]) -> List[Dict]:
+        """Building the {'text', 'answer'} dicts for the hits, the rest of the app expects
+        that shape. One take() per column gathers all k rows at once."""
+        positions = pa.array(indices, type=pa.int64())
+        texts = pc.take(self.chunks_text, positions).to_pylist()
+        answers = pc.take(self.chunks_answer, positions).to_pylist()
+        return [{'text': t, 'answer': a} for t, a in zip(texts, answers)]
+
+    def token_counts(self, results: List[Dict]) -> List[Optional[int]]:
+        """Build-time token counts of the texts of retrieved chunks (None for builds without
+        a token_count column), for the prompt budgets. Kept out of the result dicts."""
+        if self.chunks_tokens is None:
+            return [None] * len(results)
+        positions = pa.array([r['index'] for r in results], type=pa.int64())
+        return pc.take(self.chunks_tokens, positions).to_pylist()
+
+    def get_response(self, query: str, k: int = 3, pretty: bool = False):
         """Retrieving here the relevant context and generate SQL query."""
         contexts = self.get_relevant_chunks(query, k)
-        result = self.generator.generate_query(query, [c['chunk'] for c in contexts])
+        result = self.generator.generate_query(
+            query, [c['chunk'] for c in contexts], pretty=pretty, token_counts=self.token_counts(contexts)
+        )
         return {
             "contexts": contexts,
             "generated_sql": result["sql"],
@@ -185,29 +1121,313 @@ class Retriever:
             "validation_message": result["validation_message"]
         }
 
+    def get_response_json(self, query: str, k: int = 3, pretty: bool = False) -> bytes:
+        """get_response already serialized, for anything that sends it over HTTP.
+        orjson writes it in C, and OPT_SERIALIZE_NUMPY takes numpy values as they are."""
+        return orjson.dumps(self.get_response(query, k, pretty), option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Encoding the queries in one forward pass, skipping the exact strings I have
+        already seen (LRU). Returns a (len(queries), dim) float32 array."""
+        out = np.empty((len(queries), self.model.get_sentence_embedding_dimension()), dtype='float32')
+        missing = []
+        with self._exact_lock:
+            for row, query in enumerate(queries):
+                emb = self._exact_cache.get(query)
+                if emb is None:
+                    missing.append(row)
+                    continue
+                self._exact_cache.move_to_end(query)
+                out[row] = emb
+        if missing:
+            # The vectors come out unit-norm either from the model's own Normalize module or,
+            # for models without one, from normalize_embeddings inside the forward pass.
+            # precision='float32' pins the dtype FAISS/the matmul want, so encode's array
+            # is used as it is: no np.array(...).astype copy and no extra normalize pass
+            with _inference_mode():
+                embs = self.model.encode(
+                    [queries[row] for row in missing],
+                    batch_size=len(missing),
+                    convert_to_numpy=True,
+                    normalize_embeddings=self._needs_norm,
+                    precision='float32',
+                )
+            with self._exact_lock:
+                for row, emb in zip(missing, embs):
+                    self._exact_cache[queries[row]] = emb
+                    if len(self._exact_cache) > self.cache_size:
+                        self._exact_cache.popitem(last=False)
+            if len(missing) == len(queries):
+                # Nothing came from the LRU (the usual single new query)
+                return embs
+            out[missing] = embs
+        return out
+
+    def _search(self, query_embedding: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k inner product search, returns (distances, indices) shaped (n_queries, k) like FAISS does.
+        For a corpus this size a BLAS matmul + argpartition beats IndexFlatIP.search."""
+        if self.gpu_index is not None:
+            # torch_utils lets the GPU index take a CUDA tensor, results come back as tensors
+            import torch  # pylint: disable=import-outside-toplevel
+            distances, indices = self.gpu_index.search(torch.from_numpy(np.ascontiguousarray(query_embedding)).cuda(), k)
+            return distances.cpu().numpy(), indices.cpu().numpy()
+        if self.corpus is None:
+            if self.rerank_vectors is None:
+                return self.index.search(query_embedding, k)
+            _, candidates = self.index.search(query_embedding, max(k, self.rerank_depth))
+            return self._rerank(query_embedding, candidates, k)
+        scores = query_embedding @ self.corpus.T
+        top3 = _top3_kernel() if k == 3 and NUMBA_AVAILABLE else None
+        if top3 is not None:
+            return top3(scores)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+    def _rerank(self, query_embedding: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Re-scoring the PQ candidates with the exact inner product and keeping the best k."""
+        # An IVF index can come back with fewer than k real candidates (-1 padding),
+        # the missing slots stay padded the way FAISS pads them: index -1, score -inf
+        distances = np.full((len(candidates), k), -np.inf, dtype='float32')
+        indices = np.full((len(candidates), k), -1, dtype='int64')
+        for row, (q, cand) in enumerate(zip(query_embedding, candidates)):
+            cand = cand[cand >= 0]
+            exact = self.rerank_vectors[cand].astype('float32') @ q
+            order = np.argsort(-exact)[:k]
+            distances[row, :len(order)], indices[row, :len(order)] = exact[order], cand[order]
+        return distances, indices
+
+    def _resolve(self, requests: List[Tuple[str, int]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Answering a batch of (query, k) requests, each as (distances, indices) of shape (1, k).
+        Stored results of the same or a near-identical earlier query are reused; whatever is
+        left is encoded in one forward pass and searched with one (batch, N) matmul.
+        """
+        store = self.cache
+        out: List = [None] * len(requests)
+
+        # 1. exact hits from the persistent store
+        pending = []
+        for pos, (query, k) in enumerate(requests):
+            hit = store.lookup(query) if store is not None else None
+            if hit is not None and hit[2].shape[1] >= k:
+                out[pos] = (hit[1][:, :k], hit[2][:, :k])
+            else:
+                pending.append((pos, hit))
+        if not pending:
+            return out
+
+        # 2. one encoder forward for the queries that still need an embedding, then paraphrase hits
+        new_rows = [pos for pos, hit in pending if hit is None]
+        embs = self._embed_queries([requests[pos][0] for pos in new_rows])
+        new_embs = {pos: embs[row:row + 1] for row, pos in enumerate(new_rows)}
+        to_search = []
+        for pos, hit in pending:
+            k = requests[pos][1]
+            if hit is None:
+                emb = new_embs[pos]
+                near = store.nearest(emb, self.cache_threshold) if store is not None else None
+                if near is not None and near[2].shape[1] >= k:
+                    out[pos] = (near[1][:, :k], near[2][:, :k])
+                    continue
+                # A paraphrase with too small a k is not reused, and its row is left alone:
+                # this query gets searched and stored as its own entry below
+            else:
+                emb = store.embedding(hit[0])
+            to_search.append((pos, emb, hit))
+        if not to_search:
+            return out
+
+        # 3. one search for everything that is left
+        distances, indices = self._search(
+            np.vstack([emb for _, emb, _ in to_search]), max(requests[pos][1] for pos, _, _ in to_search)
+        )
+        for row, (pos, emb, hit) in enumerate(to_search):
+            query, k = requests[pos]
+            result = (distances[row:row + 1, :k], indices[row:row + 1, :k])
+            if store is not None:
+                if hit is not None:
+                    # Same question (exact lookup) asked with a bigger k, so I just widen the cached result
+                    store.update(hit[0], *result)
+                else:
+                    store.put(query, emb, *result)
+            out[pos] = result
+        return out
+
+    async def aget_response(self, query: str, k: int = 3, pretty: bool = False):
+        """Async get_response: retrieval runs in a worker thread (where concurrent calls
+        share the micro-batcher), then the SQL is generated on Gemini's async client."""
+        contexts = await asyncio.to_thread(self.get_relevant_chunks, query, k)
+        result = await self.generator.agenerate_query(
+            query, [c['chunk'] for c in contexts], pretty=pretty, token_counts=self.token_counts(contexts)
+        )
+        return {
+            "contexts": contexts,
+            "generated_sql": result["sql"],
+            "valid": result["valid"],
+            "validation_message": result["validation_message"]
+        }
+
+    async def aget_responses(self, queries: List[str], k: int = 3, concurrency: int = 20):
+        """Answering many questions concurrently, one's retrieval overlaps with the others' Gemini calls."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(query: str):
+            async with semaphore:
+                return await self.aget_response(query, k)
+
+        return await asyncio.gather(*(one(q) for q in queries))
+
+    def _cache_key(self, query: str) -> str:
+        query = query.strip()
+        return query.lower() if self._lowercase_keys else query
+
+    def _clamp_k(self, k: int) -> int:
+        # Checked here, before anything is queued: argpartition would quietly take k <= 0
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        return min(k, self.num_chunks)
+
     def get_relevant_chunks(self, query: str, k: int = 3):
         """Performing semantic search in the FAISS index."""
-        query_embedding = np.array(self.model.encode([query])).astype('float32')
-        faiss.normalize_L2(query_embedding)
-        k = min(k, len(self.chunks))
-        distances, indices = self.index.search(query_embedding, k)
-        results = []
-        for rank, idx in enumerate(indices[0]):
-            results.append({
-                'rank': rank + 1,
-                'index': int(idx),
-                'score': float(distances[0][rank]),
-                'chunk': self.chunks[idx]
-            })
-        return results
+        k = self._clamp_k(k)
+        distances, indices = self._batcher.submit((self._cache_key(query), k)).result()
+        return self._results(distances, indices)
+
+    def prefetch(self, query: str) -> None:
+        """Embedding a question before it is asked (the terminal REPL calls this while the
+        user is still typing), so the real lookup finds it in the embedding LRU."""
+        self._embed_queries([self._cache_key(query)])
+
+    def get_relevant_chunks_batch(self, queries: List[str], k: int = 3) -> List[List[Dict]]:
+        """Same as get_relevant_chunks for a list of questions. They are all queued at once,
+        so the batcher runs them max_batch at a time through one encoder forward and one search."""
+        k = self._clamp_k(k)
+        futures = [self._batcher.submit((self._cache_key(q), k)) for q in queries]
+        return [self._results(*future.result()) for future in futures]
+
+    def _results(self, distances: np.ndarray, indices: np.ndarray) -> List[Dict]:
+        # FAISS pads with -1 when an ANN index finds fewer than k neighbours
+        found = indices[0] >= 0
+        # tolist() turns the whole row into Python ints/floats in one C call
+        idxs, scores = indices[0, found].tolist(), distances[0, found].tolist()
+        chunks = self._chunks(idxs)
+        return [
+            {'rank': rank, 'index': idx, 'score': score, 'chunk': chunk}
+            for rank, (idx, score, chunk) in enumerate(zip(idxs, scores, chunks), 1)
+        ]
 
 
 # ===== CLI / main =====
 # I included a simple command-line interface for local testing
 # — helps verify retriever and SQL generation logic before using Streamlit.
 
+@st.cache_resource
+def _retriever_registry() -> Dict[tuple, Retriever]:
+    """get_or_create's registry for the Streamlit server. Every rerun executes this file
+    as a fresh module, so _RETRIEVERS would start empty each time and never close the
+    Retriever of an older build."""
+    return {}
+
+
+def _build_mtimes() -> tuple:
+    return tuple(_mtime(p) for p in ('embeddings.faiss', 'chunks.arrow', 'embeddings.npy'))
+
+
+@st.cache_resource(max_entries=1)
+def get_retriever(build: tuple = ()) -> Retriever:  # pylint: disable=unused-argument
+    """Streamlit reruns the whole script on every input, so I keep one Retriever
+    (and with it the model) alive for the server process. `build` is only there for
+    the cache key: pass _build_mtimes() and rebuilt embeddings/chunks get a new
+    Retriever without restarting the server (get_or_create closes the old one)."""
+    return Retriever.get_or_create(registry=_retriever_registry())
+
+
+# Checked before loading, so a missing key isn't reported as missing index files
+# (SQLGenerator raises a RuntimeError for it, same as faiss does for a broken index)
+_NO_API_KEY = "GEMINI_API_KEY is not set. Add it to the environment or to the .env file."
+
+
+def load_retriever() -> Retriever:
+    """get_retriever for the pages: missing or broken index/chunk files end up here
+    (FileNotFoundError from numpy/pyarrow/open, RuntimeError from faiss) and are shown
+    as a message instead of a traceback."""
+    if not os.getenv("GEMINI_API_KEY"):
+        st.error(_NO_API_KEY)
+        st.stop()
+        raise RuntimeError(_NO_API_KEY)
+    try:
+        return get_retriever(_build_mtimes())
+    except (FileNotFoundError, RuntimeError) as e:
+        st.error(f"Could not load the retriever: {e}\nRun create_embeddings.py to build the index files.")
+        st.stop()
+        raise
+
+
+_ANSWER_CONTEXT_TOKENS = 2048
+
+
+def answer_with_sql(retriever: Retriever, query: str, contexts: List[Dict],
+                    on_partial: Optional[Callable[[str], None]] = None,
+                    on_answer_partial: Optional[Callable[[str], None]] = None) -> Tuple[Dict, str]:
+    """
+    The SQL and the natural-language answer are two independent Gemini round-trips,
+    so the answer runs in a worker thread while the SQL is generated here.
+    Both callbacks are only ever called on the calling thread, because they usually
+    update Streamlit elements and those can't be touched from other threads: the
+    worker hands its partial answers over through a queue.
+    Returns (sql_result, gemini_answer).
+    """
+    # Only as much (and as little repeated) context as the answer prompt budget allows
+    contexts = _pack_contexts(
+        contexts, retriever.token_counts(contexts), _ANSWER_CONTEXT_TOKENS, retriever.generator._count_tokens
+    ) or contexts[:1]
+    context_text = "\n".join(c['chunk']['text'] for c in contexts)
+    answer_updates: "queue.Queue[str]" = queue.Queue()
+
+    def show_latest_answer() -> None:
+        latest, restarted = None, False
+        while True:
+            try:
+                latest = answer_updates.get_nowait()
+            except queue.Empty:
+                break
+            restarted = restarted or latest == ""
+        # A restarted stream: the "" signal is passed on, not coalesced away
+        if restarted and latest:
+            on_answer_partial("")
+        if latest is not None:
+            on_answer_partial(latest)
+
+    def sql_partial(text: str) -> None:
+        if on_partial is not None:
+            on_partial(text)
+        if on_answer_partial is not None:
+            show_latest_answer()
+
+    streaming = on_partial is not None or on_answer_partial is not None
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        answer_future = pool.submit(
+            ask_gemini, f"Use the following context to answer the question:\n{context_text}\nQuestion: {query}",
+            answer_updates.put if on_answer_partial is not None else None
+        )
+        result = retriever.generator.generate_query(
+            query, [c['chunk'] for c in contexts], on_partial=sql_partial if streaming else None, pretty=True,
+            token_counts=retriever.token_counts(contexts)
+        )
+        # The SQL is done, keep showing the answer as it streams in
+        while on_answer_partial is not None:
+            try:
+                on_answer_partial(answer_updates.get(timeout=0.05))
+            except queue.Empty:
+                if answer_future.done():
+                    break
+        return result, answer_future.result()
+
+
 def main():
-    retriever = Retriever()
+    retriever = load_retriever()
     st.set_page_config(page_title="RAG Gemini Chatbot", layout="wide")
     st.title("RAGent")
     st.write("Welcome! Choose your mode:")
@@ -245,23 +1465,110 @@ def main():
                     st.write(f"Schema: {chunk.get('text')}")
                     st.write(f"SQL: {chunk.get('answer')}\n")
             else:
-                response_data = retriever.get_response(query, k=k)
-                generated_sql = response_data.get("generated_sql", "[No SQL generated]")
-                contexts = response_data.get("contexts", [])
-                top_chunks_text = [c['chunk']['text'] for c in contexts]
-                context_text = "\n".join(top_chunks_text)
-                gemini_answer = ask_gemini(
-                    f"Use the following context to answer the question:\n{context_text}\nQuestion: {query}"
-                )
+                contexts = retriever.get_relevant_chunks(query, k=k)
                 st.write("---")
-                st.write("**Gemini:**", gemini_answer)
-                st.write("**Generated SQL:**", generated_sql)
+                answer_slot = st.empty()
+                sql_slot = st.empty()
                 st.write("---")
+                result, gemini_answer = answer_with_sql(
+                    retriever, query, contexts,
+                    on_partial=lambda text: sql_slot.write("**Generated SQL:**", text),
+                    on_answer_partial=lambda text: answer_slot.write("**Gemini:**", text)
+                )
+                answer_slot.write("**Gemini:**", gemini_answer)
+                sql_slot.write("**Generated SQL:**", result["sql"] or "[No SQL generated]")
 # 1. Retriever-only mode:  which just shows retrieved contexts and example SQL
 # 2. Full RAG pipeline mode on: context retrieval + Gemini SQL generation
 # 3. Asking Gemini for a natural language answer too
 
 
+# Terminal mode (python app.py --cli). With prompt_toolkit installed the question is
+# embedded in the background whenever typing pauses for a moment, so by the time Enter
+# is pressed the encoder forward is usually already done. Without it, plain input().
+PROMPT_TOOLKIT_AVAILABLE = _installed("prompt_toolkit")
+_PREFETCH_DEBOUNCE = 0.15
+
+
+def _question_reader(retriever: Retriever) -> Callable[[], str]:
+    if not PROMPT_TOOLKIT_AVAILABLE:
+        return lambda: input("Question> ")
+    from prompt_toolkit import PromptSession  # pylint: disable=import-outside-toplevel
+
+    session = PromptSession()
+    pending: List[Optional[threading.Timer]] = [None]
+
+    def on_text_changed(buffer) -> None:
+        if pending[0] is not None:
+            pending[0].cancel()
+        if buffer.text.strip():
+            pending[0] = threading.Timer(_PREFETCH_DEBOUNCE, retriever.prefetch, (buffer.text,))
+            pending[0].daemon = True
+            pending[0].start()
+
+    session.default_buffer.on_text_changed += on_text_changed
+    return lambda: session.prompt("Question> ")
+
+
+def run_cli():
+    if not os.getenv("GEMINI_API_KEY"):
+        print(_NO_API_KEY)
+        return
+    try:
+        retriever = Retriever.get_or_create()
+    except (FileNotFoundError, RuntimeError) as e:
+        print(f"Could not load the retriever: {e}\nRun create_embeddings.py to build the index files.")
+        return
+    read_question = _question_reader(retriever)
+    k = 3
+    print("Type 'k=5' to change the number of results, 'exit' to quit.")
+    while True:
+        try:
+            query = read_question().strip()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if not query:
+            continue
+        if query.lower() in ("exit", "quit"):
+            break
+        if query.startswith("k="):
+            try:
+                new_k = int(query[2:])
+            except ValueError:
+                new_k = 0
+            if new_k < 1:
+                print("Invalid number for k")
+            else:
+                k = new_k
+                print(f"Number of results set to {k}")
+            continue
+
+        contexts = retriever.get_relevant_chunks(query, k=k)
+        for c in contexts:
+            print(f"[{c['rank']}] score={c['score']:.4f}  {c['chunk']['text']}")
+        # The answer streams in, only the new part of the text is printed each time.
+        # After a timeout the stream starts over, _gemini_text signals that with ""
+        shown = [""]
+
+        def print_new(text: str) -> None:
+            if not text:
+                sys.stdout.write("\n[retrying]\n")
+                shown[0] = ""
+                return
+            if not text.startswith(shown[0]):
+                # Not a continuation, e.g. the error message after a stream failed half way
+                sys.stdout.write("\n")
+                shown[0] = ""
+            sys.stdout.write(text[len(shown[0]):])
+            sys.stdout.flush()
+            shown[0] = text
+
+        print("Gemini: ", end="", flush=True)
+        result, answer = answer_with_sql(retriever, query, contexts, on_answer_partial=print_new)
+        if answer:
+            print_new(answer)
+        print(f"\nGenerated SQL:\n{result['sql'] or '[No SQL generated]'}\n")
+
+
 # ===== UI Continue =====
 # A friendly UI so others can interact with the chatbot visually.
 # Note-> to myslef->  i will improve 
@@ -272,27 +1579,30 @@ def run_streamlit():
         "and the model will retrieve relevant context, generate SQL, and answer using Gemini."
     )
 
-    retriever = Retriever()
+    retriever = load_retriever()
 
     query = st.text_input("Your question:")
     if query:
-        with st.spinner("Processing..."):
-            response_data = retriever.get_response(query)
-            generated_sql = response_data.get("generated_sql", "[No SQL generated]")
-            contexts = response_data.get("contexts", [])
-            top_chunks_text = [c['chunk']['text'] for c in contexts if 'chunk' in c and 'text' in c['chunk']]
-            context_text = "\n".join(top_chunks_text)
-            gemini_answer = ask_gemini(f"Use the following context to answer the question:\n{context_text}\nQuestion: {query}")
-
+        # Retrieval is fast, so the contexts show up right away and the two
+        # Gemini answers fill in below as they arrive
+        contexts = retriever.get_relevant_chunks(query)
         st.subheader("Retrieved Contexts")
-        for i, text in enumerate(top_chunks_text, 1):
-            st.markdown(f"**Rank {i}:** {text[:200]}{'...' if len(text) > 200 else ''}")
+        for c in contexts:
+            text = c['chunk']['text']
+            st.markdown(f"**Rank {c['rank']}:** {text[:200]}{'...' if len(text) > 200 else ''}")
 
         st.subheader("Generated SQL")
-        st.code(generated_sql, language="sql")
-
+        sql_slot = st.empty()
         st.subheader("Gemini Answer")
-        st.markdown(gemini_answer)
+        answer_slot = st.empty()
+        with st.spinner("Processing..."):
+            result, gemini_answer = answer_with_sql(
+                retriever, query, contexts,
+                on_partial=lambda text: sql_slot.code(text, language="sql"),
+                on_answer_partial=answer_slot.markdown
+            )
+        sql_slot.code(result["sql"] or "[No SQL generated]", language="sql")
+        answer_slot.markdown(gemini_answer)
 
 
 # Finally we have come to the end of my Project thank you for your inspiring mentor tea-time & Webinars.
@@ -303,5 +1613,7 @@ def run_streamlit():
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "--streamlit":
         run_streamlit()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--cli":
+        run_cli()
     else:
         main()
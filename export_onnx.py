@@ -0,0 +1,38 @@
+"""
+Export the query encoder (all-mpnet-base-v2) to ONNX and quantize it to int8.
+
+Every user question goes through this model, and in FP32 PyTorch on CPU that
+is the slowest part of retrieval. ONNX Runtime with dynamic int8 quantization
+(AVX-512 VNNI) runs the same network a lot faster, so I export it once here and
+the chatbot loads it with Retriever(onnx_path='onnx_encoder_int8').
+
+The corpus embeddings stay the ones from create_embeddings.py; int8 only
+changes the query side a little, which is fine for top-k retrieval.
+"""
+
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+MODEL_ID = "sentence-transformers/all-mpnet-base-v2"
+EXPORT_DIR = "onnx_encoder"
+QUANTIZED_DIR = "onnx_encoder_int8"
+
+
+def main() -> None:
+    """Exporting the FP32 graph, then saving the int8 version plus the tokenizer next to it."""
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    model.save_pretrained(EXPORT_DIR)
+
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=QUANTIZED_DIR, quantization_config=qconfig)
+
+    # The Retriever loads tokenizer and config from the same folder as the model
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(QUANTIZED_DIR)
+    model.config.save_pretrained(QUANTIZED_DIR)
+    print(f"Saved int8 ONNX encoder to: {QUANTIZED_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,103 +2,103 @@
 This file is for loading and cleaning SQL question-answer JSON data and save processed chunks.
 
 This script:
-- Loads 'sql_create_context_v4.json' (our raw SQL Q&A data)
+- Streams 'sql_create_context_v4.json' (our raw SQL Q&A data) entry by entry with ijson
 - Removes entries missing 'question', 'context', or 'answer' (keeps only usable data)
 - Strips whitespace (makes everything neat)
 - Produces 'processed_chunks.json' containing {'text': "...", 'answer': "...'}
   which we will later feed into the chatbot
+All of it happens in a single pass, so the raw data, the cleaned list and the
+chunks are never held in memory at the same time.
 """
 
-import json
-from typing import List, Dict
-#As I just mentioned you are seeing the entry of the file and the result of this code 
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import ijson
+import orjson
+#As I just mentioned you are seeing the entry of the file and the result of this code
 INPUT_FILE = "sql_create_context_v4.json"
 OUTPUT_FILE = "processed_chunks.json"
+REQUIRED_FIELDS = ("question", "context", "answer")
 
 
-def load_json(path: str) -> List[Dict]:
-    """Load JSON file and return parsed data."""
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-def save_json(path: str, data: List[Dict]) -> None:
-    """Save data now so it can make it 
-    it easier for whom want to inspect later, not just machine-readable.
-."""
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-
-def clean_entries(data: List[Dict]) -> List[Dict]:
-    """Returning entries that contain question context & answer fields, avoiding the fail."""
-    cleaned: List[Dict] = [
-        entry for entry in data
-        if isinstance(entry, dict)
-        and "question" in entry
-        and "context" in entry
-        and "answer" in entry
-    ]
+def to_chunk(entry: Dict) -> Optional[Dict]:
+    """Turning one raw entry into a chunk, or None if it misses question context & answer fields.
+    Context and question are combined bcz this is exactly the format my chatbot expects: 'text' + 'answer'.
+    """
+    if not isinstance(entry, dict) or any(field not in entry for field in REQUIRED_FIELDS):
+        return None
     # Strip whitespace from all string fields — makes everything consistent
+    question, context, answer = (
+        entry[field].strip() if isinstance(entry[field], str) else entry[field]
+        for field in REQUIRED_FIELDS
+    )
+    return {"text": f"Context: {context}\nQuestion: {question}", "answer": answer}
+
+
+def stream_chunks(path: str, stats: Optional[Dict] = None) -> Iterator[Dict]:
+    """Reading the JSON array item by item and yielding chatbot-ready chunks.
+    If a stats dict is given, it is filled with the counts and first/last raw entries."""
+    if stats is not None:
+        stats.update(total=0, kept=0, first=None, last=None)
+    with open(path, "rb") as f:
+        # use_float: numbers come back as float instead of Decimal, which orjson can't write
+        for entry in ijson.items(f, "item", use_float=True):
+            chunk = to_chunk(entry)
+            if stats is not None:
+                stats["total"] += 1
+                stats["first"] = stats["first"] or entry
+                stats["last"] = entry
+                stats["kept"] += chunk is not None
+            if chunk is not None:
+                yield chunk
 
-    for entry in cleaned:
-        if isinstance(entry.get("question"), str):
-            entry["question"] = entry["question"].strip()
-        if isinstance(entry.get("context"), str):
-            entry["context"] = entry["context"].strip()
-        if isinstance(entry.get("answer"), str):
-            entry["answer"] = entry["answer"].strip()
 
-    return cleaned
-
-
-def create_chunks(cleaned: List[Dict]) -> List[Dict]:
-    """Combining context and question into text chunks bcz 
-    this is exactly the format my chatbot expects: 'text' + 'answer'.
-    """    
-    chunks: List[Dict] = []
-    for entry in cleaned:
-        text_chunk = (
-            f"Context: {entry['context']}\n"
-            f"Question: {entry['question']}"
-        )
-        chunks.append({"text": text_chunk, "answer": entry["answer"]})
-    return chunks
+def process_data(data: List[Dict]) -> List[Dict]:
+    """Clean and process already loaded SQL data for my chatbot usage."""
+    return [chunk for chunk in map(to_chunk, data) if chunk is not None]
 
 
-def process_data(data: List[Dict]) -> List[Dict]:
-    """Clean and process the SQL data for my chatbot usage."""
-    cleaned = clean_entries(data)
-    return create_chunks(cleaned)
+def save_json_stream(path: str, chunks: Iterable[Dict]) -> int:
+    """Writing the chunks as a JSON array one by one (orjson, indented so it is
+    easier for whom want to inspect later, not just machine-readable).
+    Returns how many chunks were written."""
+    count = 0
+    with open(path, "wb") as f:
+        f.write(b"[")
+        for chunk in chunks:
+            f.write(b",\n" if count else b"\n")
+            f.write(orjson.dumps(chunk, option=orjson.OPT_INDENT_2))
+            count += 1
+        f.write(b"\n]\n")
+    return count
 
 
 def main() -> None:
     """Main execution function to load, clean, and save data plus
     Here I also printed some samples to double check my processing."""
-    data = load_json(INPUT_FILE)
-    print(f"Total records: {len(data)}")
-     # Checking first last entries 
-    if len(data) > 0 and isinstance(data[0], dict):
-        print(f"First question: {data[0].get('question')}")
-        print(f"The answer: {data[0].get('answer')}")
-        print(f"Last question: {data[-1].get('question')}")
-        print(f"The answer: {data[-1].get('answer')}")
-    print(f"Type of data: {type(data)}")
+    stats: Dict = {}
+
+    def with_samples(chunks: Iterator[Dict]) -> Iterator[Dict]:
+        # Showing first three samples while they stream by
+        for i, chunk in enumerate(chunks):
+            if i < 3:
+                print(f"Sample {i + 1} Text: {chunk['text']}")
+                print(f"Sample {i + 1} Answer: {chunk['answer']}")
+                print("------")
+            yield chunk
+
+    # Converting the raw data into chatbot-ready chunks and saving them in one go
+    written = save_json_stream(OUTPUT_FILE, with_samples(stream_chunks(INPUT_FILE, stats)))
+
+    print(f"Total records: {stats['total']}")
+     # Checking first last entries
+    for label, entry in (("First", stats["first"]), ("Last", stats["last"])):
+        if isinstance(entry, dict):
+            print(f"{label} question: {entry.get('question')}")
+            print(f"The answer: {entry.get('answer')}")
     # Clean entries plus check how many survived
-    cleaned = clean_entries(data)
-    print(f"Clean entries: {len(cleaned)} out of {len(data)}")
-    # Showing first three samples
-    for i, entry in enumerate(cleaned[:3]):
-        print(f"Sample {i + 1} Question: {entry['question']}")
-        print(f"Sample {i + 1} Context: {entry['context']}")
-        print(f"Sample {i + 1} Answer: {entry['answer']}")
-        print("------")
-       
-    # Converting cleaned data into chatbot-ready chunks
-    chunks = create_chunks(cleaned)
-    print(f"Total chunks created: {len(chunks)}")
-
-    save_json(OUTPUT_FILE, chunks)
+    print(f"Clean entries: {stats['kept']} out of {stats['total']}")
+    print(f"Total chunks created: {written}")
     print(f"Saved processed chunks to: {OUTPUT_FILE}")
 
 
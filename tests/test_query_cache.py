@@ -0,0 +1,201 @@
+"""Tests for Retriever search and the persistent query cache (CacheStore) it uses."""
+import os
+import sys
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  pylint: disable=wrong-import-position
+
+DIM = 4
+
+
+class FakeEncoder:
+    """Fixed, unit-norm query vectors, so the tests don't need the real model."""
+
+    tokenizer = None
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def eval(self):
+        return self
+
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+    def encode(self, sentences, **_kwargs):
+        return np.stack([self.vectors[s] for s in sentences]).astype('float32')
+
+
+def _unit(v):
+    v = np.asarray(v, dtype='float32')
+    return v / np.linalg.norm(v)
+
+
+def _write_corpus(folder, corpus):
+    np.save(folder / 'embeddings.npy', np.stack([_unit(v) for v in corpus]))
+    table = pa.table({
+        'text': [f"t{i}" for i in range(len(corpus))],
+        'answer': [f"a{i}" for i in range(len(corpus))],
+    })
+    with pa.OSFile(str(folder / 'chunks.arrow'), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+@pytest.fixture
+def make_retriever(tmp_path, monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    app._MODEL_SINGLETON.clear()
+    made = []
+
+    def make(vectors, **kwargs):
+        monkeypatch.setattr(app, '_load_model', lambda *_a, **_k: FakeEncoder(vectors))
+        retriever = app.Retriever(
+            index_path=str(tmp_path / 'embeddings.faiss'),
+            chunks_path=str(tmp_path / 'chunks.arrow'),
+            corpus_path=str(tmp_path / 'embeddings.npy'),
+            cache_path=str(tmp_path / 'query_cache'),
+            use_gpu=False,
+            **kwargs,
+        )
+        made.append(retriever)
+        return retriever
+
+    yield make
+    for retriever in made:
+        retriever.close()
+
+
+def _indices(results):
+    return [r['index'] for r in results]
+
+
+def test_paraphrase_with_smaller_k_does_not_overwrite_neighbour(tmp_path, make_retriever):
+    corpus = [[1, 0, 0, 0], [0.9, 0.3, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0.8, 0.5, 0.2, 0], [0.5, 0, 0, 1]]
+    _write_corpus(tmp_path, corpus)
+    a = _unit([1, 0.1, 0, 0])
+    b = _unit([1, 0.35, 0, 0])
+    assert float(a @ b) >= 0.95  # b is a paraphrase of a for the cache
+    retriever = make_retriever({'a': a, 'b': b})
+    exact = app.Retriever._search(retriever, np.stack([a, b]), 3)[1]
+    assert exact[0].tolist() != exact[1].tolist()
+
+    retriever.get_relevant_chunks('a', k=1)
+    assert _indices(retriever.get_relevant_chunks('b', k=3)) == exact[1].tolist()
+    assert _indices(retriever.get_relevant_chunks('a', k=3)) == exact[0].tolist()
+    assert retriever.cache.lookup('b') is not None
+
+
+def test_cache_is_cleared_when_the_corpus_is_rebuilt(tmp_path, make_retriever):
+    vectors = {'q': _unit([0, 0.2, 1, 0.1])}
+    _write_corpus(tmp_path, [[1, 0, 0, 0]] * 30 + [[0, 0, 1, 0]] * 10)
+    old = make_retriever(vectors)
+    assert _indices(old.get_relevant_chunks('q', k=3))[0] >= 30
+
+    # Rebuilt with fewer chunks: the old cached indices would be out of range
+    _write_corpus(tmp_path, [[0, 0, 1, 0], [1, 0, 0, 0], [0, 1, 0, 0]])
+    os.utime(tmp_path / 'embeddings.npy', ns=(1, 1))
+    new = make_retriever(vectors)
+    assert new.cache.lookup('q') is None
+    assert _indices(new.get_relevant_chunks('q', k=3)) == [0, 2, 1]
+
+
+def test_cache_is_kept_for_the_same_build_and_cleared_for_another_encoder(tmp_path):
+    path = str(tmp_path / 'query_cache')
+    emb = _unit([1, 0, 0, 0])[None, :]
+    store = app.CacheStore(path, DIM, fingerprint='corpus-v1|mpnet')
+    store.put('q', emb, np.array([[0.9]], dtype='float32'), np.array([[7]]))
+
+    assert app.CacheStore(path, DIM, fingerprint='corpus-v1|mpnet').lookup('q') is not None
+    other = app.CacheStore(path, DIM, fingerprint='corpus-v1|onnx_encoder_int8')
+    assert other.lookup('q') is None
+    assert other.nearest(emb, 0.5) is None
+    assert app.CacheStore(path, DIM, fingerprint='corpus-v1|mpnet').lookup('q') is None
+
+
+def test_two_processes_sharing_the_cache_get_different_rows(tmp_path):
+    # Two stores opened before either writes, like two processes on the default query_cache
+    path = str(tmp_path / 'query_cache')
+    first = app.CacheStore(path, DIM, fingerprint='v1')
+    second = app.CacheStore(path, DIM, fingerprint='v1')
+    e1, e2 = _unit([1, 0, 0, 0])[None, :], _unit([0, 1, 0, 0])[None, :]
+    first.put('q1', e1, np.array([[0.9]], dtype='float32'), np.array([[1]]))
+    second.put('q2', e2, np.array([[0.8]], dtype='float32'), np.array([[2]]))
+
+    assert first.lookup('q1')[0] != second.lookup('q2')[0]
+    for store in (first, second):
+        assert store.nearest(e1, 0.95)[2].tolist() == [[1]]
+        assert store.nearest(e2, 0.95)[2].tolist() == [[2]]
+
+
+def test_get_or_create_closes_the_retriever_of_an_older_build(tmp_path, make_retriever, monkeypatch):
+    corpus = [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]]
+    _write_corpus(tmp_path, corpus)
+    monkeypatch.setattr(app, '_load_model', lambda *_a, **_k: FakeEncoder({'q': _unit([1, 0, 0, 0])}))
+    registry = {}
+    kwargs = dict(
+        index_path=str(tmp_path / 'embeddings.faiss'),
+        chunks_path=str(tmp_path / 'chunks.arrow'),
+        corpus_path=str(tmp_path / 'embeddings.npy'),
+        cache_path=str(tmp_path / 'query_cache'),
+        use_gpu=False,
+        registry=registry,
+    )
+    old = app.Retriever.get_or_create(**kwargs)
+    assert app.Retriever.get_or_create(**kwargs) is old
+    assert _indices(old.get_relevant_chunks('q', k=1)) == [0]
+
+    stat = os.stat(tmp_path / 'embeddings.npy')
+    os.utime(tmp_path / 'embeddings.npy', (stat.st_atime, stat.st_mtime + 10))
+    new = app.Retriever.get_or_create(**kwargs)
+    try:
+        assert new is not old and list(registry.values()) == [new]
+        assert not any(t.is_alive() for t in old._batcher._threads)
+        with pytest.raises(RuntimeError):
+            old.get_relevant_chunks('q', k=1)
+        assert _indices(new.get_relevant_chunks('q', k=1)) == [0]
+    finally:
+        new.close()
+
+
+@pytest.mark.parametrize('k', [0, -1])
+def test_non_positive_k_is_rejected_before_it_is_queued(tmp_path, make_retriever, k):
+    _write_corpus(tmp_path, [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]])
+    retriever = make_retriever({'q': _unit([1, 0, 0, 0])})
+    with pytest.raises(ValueError):
+        retriever.get_relevant_chunks('q', k=k)
+    with pytest.raises(ValueError):
+        retriever.get_relevant_chunks_batch(['q'], k=k)
+    assert retriever.cache.lookup('q') is None
+
+
+def test_ann_cache_fingerprint_follows_the_vectors_it_was_built_from(tmp_path, make_retriever):
+    pytest.importorskip('faiss')
+    vectors = {'q': _unit([0, 0.2, 1, 0.1])}
+    # Only embeddings.npy, no embeddings.faiss: the HNSW index is built from the .npy
+    _write_corpus(tmp_path, [[1, 0, 0, 0]] * 30 + [[0, 0, 1, 0]] * 10)
+    old = make_retriever(vectors, index_factory='HNSW8', ann_min_chunks=1)
+    assert not (tmp_path / 'embeddings.faiss').exists()
+    assert _indices(old.get_relevant_chunks('q', k=3))[0] >= 30
+    assert make_retriever(vectors, index_factory='HNSW8', ann_min_chunks=1).cache.lookup('q') is not None
+
+    _write_corpus(tmp_path, [[0, 0, 1, 0], [1, 0, 0, 0], [0, 1, 0, 0]])
+    os.utime(tmp_path / 'embeddings.npy', ns=(1, 1))
+    new = make_retriever(vectors, index_factory='HNSW8', ann_min_chunks=1)
+    assert new.cache.lookup('q') is None
+    assert _indices(new.get_relevant_chunks('q', k=1)) == [0]
+
+
+def test_rerank_pads_when_the_index_finds_fewer_than_k(tmp_path, make_retriever):
+    corpus = [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0.9, 0.1, 0, 0]]
+    _write_corpus(tmp_path, corpus)
+    retriever = make_retriever({'q': _unit([1, 0, 0, 0])})
+    retriever.rerank_vectors = np.load(tmp_path / 'embeddings.npy')
+    candidates = np.array([[2, 0, 3, -1, -1, -1]])
+    distances, indices = retriever._rerank(_unit([1, 0, 0, 0])[None, :], candidates, 5)
+    assert indices.tolist() == [[0, 3, 2, -1, -1]]
+    assert np.isneginf(distances[0, 3:]).all()
+    assert [r['index'] for r in retriever._results(distances, indices)] == [0, 3, 2]
@@ -0,0 +1,56 @@
+"""The destructive-keyword check: the Aho-Corasick path and the substring + regex fallback
+must agree with the plain word-boundary regex _FORBIDDEN."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402  pylint: disable=wrong-import-position
+
+QUERIES = [
+    "SELECT updated_at FROM t",
+    "SELECT * FROM merge_t",
+    "SELECT dropped, deleted_rows, inserts FROM t",
+    "SELECT exec_time FROM t_update",
+    "SELECT _drop FROM t",
+    "SELECT drop2 FROM t",
+    "DROP TABLE t",
+    "drop table t",
+    "SELECT * FROM t; delete",
+    "SELECT 1;DELETE FROM t",
+    "x;drop",
+    "SELECT * FROM t -- drop it later",
+    "SELECT * FROM t /*UPDATE*/",
+    "SELECT * FROM t\nmerge INTO u",
+    "SELECT 'truncate' FROM t",
+    "SELECT a.update FROM t a",
+    "(ALTER)",
+    "update",
+    "ExEc",
+    "SELECT 1",
+    "",
+    "updat",
+    "SELECT überdrop, dropé FROM t",
+]
+
+
+def _fallback(monkeypatch):
+    monkeypatch.setattr(app, 'AHOCORASICK_AVAILABLE', False)
+
+
+def _automaton(monkeypatch):
+    if not app.AHOCORASICK_AVAILABLE:
+        pytest.skip("pyahocorasick is not installed")
+
+
+@pytest.mark.parametrize('path', [_automaton, _fallback], ids=['automaton', 'fallback'])
+@pytest.mark.parametrize('query', QUERIES)
+def test_has_forbidden_matches_the_word_boundary_regex(monkeypatch, path, query):
+    path(monkeypatch)
+    assert app._has_forbidden(query) == (app._FORBIDDEN.search(query) is not None)
+
+
+def test_forbidden_statement_is_rejected_and_column_names_are_not():
+    assert app.validate_sql("SELECT updated_at FROM merge_t")[0]
+    assert not app.validate_sql("SELECT 1; DROP TABLE t")[0]